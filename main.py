@@ -1,17 +1,47 @@
 import os
+import asyncio
+import hashlib
+import json
+import queue
+import httpx
+import orjson
 import streamlit as st
 from dotenv import load_dotenv
-from groq import Groq
+from groq import Groq, AsyncGroq
 from pathlib import Path
 import time
-import base64
-from pdf2image import convert_from_bytes
+import pybase64
+import pyvips
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from io import BytesIO
 from PIL import Image
 
 # Load environment variables
 load_dotenv()
 
+# On-disk cache for analysis/summary results, keyed by SHA-256 of the file bytes.
+# Survives page refreshes and app restarts, unlike st.cache_data.
+DISK_CACHE_DIR = Path.home() / ".cache" / "groq-doc"
+
+def load_cached_document(file_hash):
+    """Look up a previously analyzed document on disk, or None on miss."""
+    cache_path = DISK_CACHE_DIR / f"{file_hash}.json"
+    if cache_path.exists():
+        try:
+            return json.loads(cache_path.read_text())
+        except (OSError, json.JSONDecodeError):
+            pass
+    return None
+
+def store_cached_document(file_hash, result):
+    """Persist an analyzed document to the on-disk cache."""
+    cache_path = DISK_CACHE_DIR / f"{file_hash}.json"
+    DISK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(result))
+    os.replace(tmp_path, cache_path)  # atomic, so readers never see partial JSON
+
 def initialize_session_state():
     """Initialize session state variables for the Streamlit app."""
     if 'messages' not in st.session_state:
@@ -24,112 +54,315 @@ def initialize_session_state():
         st.session_state.analysis = None
     if 'current_file' not in st.session_state:
         st.session_state.current_file = None
+    if 'analysis_job' not in st.session_state:
+        st.session_state.analysis_job = None
+    if 'analysis_errors' not in st.session_state:
+        st.session_state.analysis_errors = []
+
+@st.cache_resource
+def get_analysis_executor():
+    """Background executor for document analysis, shared across reruns."""
+    return ThreadPoolExecutor(max_workers=2)
+
+# HTTP/2 multiplexes the parallel page requests over one TCP/TLS connection,
+# avoiding per-request handshakes and connection-count head-of-line limits.
+# httpx only speaks HTTP/2 with the optional h2 package (httpx[http2])
+# installed; fall back to HTTP/1.1 rather than failing at startup without it.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+
+class _ORJSONRequestMixin:
+    """Serialize request bodies with orjson instead of stdlib json.
 
+    The Groq SDK hands httpx the messages payload via ``json=``, so the
+    multi-MB base64 data URLs were re-escaped by the stdlib encoder on
+    every request; orjson's SIMD escaping takes that off the profile.
+    """
+    def build_request(self, *args, **kwargs):
+        json_body = kwargs.pop("json", None)
+        if json_body is not None:
+            kwargs["content"] = orjson.dumps(json_body)
+            headers = httpx.Headers(kwargs.get("headers"))
+            headers["Content-Type"] = "application/json"
+            kwargs["headers"] = headers
+        return super().build_request(*args, **kwargs)
+
+class ORJSONClient(_ORJSONRequestMixin, httpx.Client):
+    pass
+
+class AsyncORJSONClient(_ORJSONRequestMixin, httpx.AsyncClient):
+    pass
+
+@st.cache_resource
 def get_groq_client():
-    """Initialize Groq client with API key from environment variables."""
+    """Initialize Groq client once per process, reusing its connection pool."""
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise ValueError("GROQ_API_KEY not found in environment variables")
-    return Groq(api_key=api_key)
+    return Groq(api_key=api_key,
+                http_client=ORJSONClient(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS))
+
+def get_async_groq_client():
+    """Initialize async Groq client; built per event loop, so not cached."""
+    api_key = os.getenv("GROQ_API_KEY")
+    if not api_key:
+        raise ValueError("GROQ_API_KEY not found in environment variables")
+    return AsyncGroq(api_key=api_key,
+                     http_client=AsyncORJSONClient(http2=HTTP2_AVAILABLE,
+                                                   limits=HTTP_LIMITS))
+
+# Llama vision models tile inputs at up to 1568 px on the long edge; anything
+# larger is resized server-side, so uploading more pixels only costs bandwidth.
+MAX_IMAGE_EDGE = 1568
 
 def encode_image_to_base64(image):
-    """Convert PIL Image to base64 data URL."""
+    """Convert PIL Image to a base64 JPEG data URL, capped at the model's input size."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > MAX_IMAGE_EDGE:
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
     buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{img_str}"
+    image.save(buffered, format="JPEG", quality=85, optimize=False)
+    # getbuffer() avoids the copy getvalue() makes; decode once at the end
+    return (b"data:image/jpeg;base64," + pybase64.b64encode(buffered.getbuffer())).decode('ascii')
 
-def convert_pdf_to_images(pdf_bytes):
-    """Convert PDF bytes to list of PIL Images."""
-    try:
-        images = convert_from_bytes(pdf_bytes)
-        return images
-    except Exception as e:
-        st.error(f"Error converting PDF to images: {str(e)}")
-        return None
+def encode_jpeg_to_data_url(jpeg_bytes):
+    """Convert JPEG bytes to a base64 data URL."""
+    return (b"data:image/jpeg;base64," + pybase64.b64encode(jpeg_bytes)).decode('ascii')
 
-def analyze_image(image_data_url):
-    """Analyze single image using the vision model."""
-    client = get_groq_client()
-    
+def _render_page(pdf_bytes, page_index):
+    """Render one PDF page to JPEG bytes. Top-level so it can run in a worker process."""
+    # 110 DPI keeps an A4/letter page under the model's 1568 px long edge,
+    # so no downsampling pass is needed after rendering.
+    page = pyvips.Image.new_from_buffer(pdf_bytes, "", dpi=110, page=page_index)
+    if page.bands == 4:
+        page = page.flatten(background=[255, 255, 255])
+    return page.jpegsave_buffer(Q=85)
+
+@st.cache_data(show_spinner=False, max_entries=4,
+               hash_funcs={bytes: lambda b: hashlib.sha256(b).hexdigest()})
+def render_pdf_jpegs(pdf_bytes):
+    """Convert PDF bytes to a list of per-page JPEG bytes using libvips.
+
+    Cached on the file's SHA-256 so re-analyzing the same PDF (e.g. after
+    Clear Chat) skips the rasterization entirely; JPEG bytes are cheap to
+    pickle, unlike PIL objects.
+    """
+    n_pages = pyvips.Image.new_from_buffer(pdf_bytes, "").get("n-pages")
+    with ProcessPoolExecutor(max_workers=min(8, os.cpu_count())) as executor:
+        return list(executor.map(_render_page, repeat(pdf_bytes), range(n_pages)))
+
+# Pages coalesced into one vision request; keeps each request's image-token
+# budget reasonable while cutting per-request round trips.
+PAGES_PER_REQUEST = 4
+
+def _vision_messages(image_data_urls, page_numbers=None):
+    """Build the vision-model message list for one or more images.
+
+    When ``page_numbers`` is given, the images are document pages and the model
+    is asked to label each analysis with its original page number.
+    """
+    if page_numbers is None:
+        prompt = "Please analyze this file and extract all relevant information in detail."
+    else:
+        pages = ", ".join(str(n) for n in page_numbers)
+        prompt = (
+            f"These images are pages {pages} of a document, in that order. "
+            "Analyze each image in turn and extract all relevant information in detail, "
+            "starting each page's analysis with a line of the form '--- Page N ---' "
+            "using the page numbers above."
+        )
+    content = [{"type": "text", "text": prompt}]
+    content.extend({"type": "image_url", "image_url": {"url": url}}
+                   for url in image_data_urls)
+    return [{"role": "user", "content": content}]
+
+async def analyze_images_async(client, image_data_urls, page_numbers=None):
+    """Analyze one or more images in a single request via the async client."""
+    completion = await client.chat.completions.create(
+        model="llama-3.2-90b-vision-preview",
+        messages=_vision_messages(image_data_urls, page_numbers),
+        temperature=0,
+        max_tokens=3990,
+        top_p=1,
+        stream=False,
+        stop=None
+    )
+
+    return completion.choices[0].message.content
+
+async def analyze_pages_async(client, jpegs, page_numbers, progress_queue):
+    """Analyze all pages concurrently in batches, bounded to respect Groq rate limits."""
+    semaphore = asyncio.Semaphore(8)
+    n_pages = len(jpegs)
+
+    async def analyze_batch(batch_index, batch_jpegs, numbers):
+        async with semaphore:
+            # Expand to base64 only once the batch is actually being sent, so
+            # at most 8 batches' worth of data URLs are alive at a time; the
+            # strings are dropped again as soon as the request returns.
+            urls = [encode_jpeg_to_data_url(jpeg) for jpeg in batch_jpegs]
+            try:
+                return batch_index, len(urls), await analyze_images_async(
+                    client, urls, page_numbers=numbers
+                )
+            except Exception as e:
+                progress_queue.put(("error", f"Error during image analysis: {str(e)}"))
+                return batch_index, len(urls), None
+
+    tasks = [
+        asyncio.create_task(analyze_batch(
+            batch_index,
+            jpegs[start:start + PAGES_PER_REQUEST],
+            page_numbers[start:start + PAGES_PER_REQUEST]
+        ))
+        for batch_index, start in enumerate(range(0, n_pages, PAGES_PER_REQUEST))
+    ]
+
+    results = [None] * len(tasks)
+    pages_done = 0
+    for task in asyncio.as_completed(tasks):
+        batch_index, batch_size, analysis = await task
+        results[batch_index] = analysis
+        pages_done += batch_size
+        progress_queue.put(("status", f"📝 Analyzed {pages_done} of {n_pages} pages"))
+        progress_queue.put(("progress", pages_done / n_pages))
+    return results
+
+async def generate_summary_async(client, analysis, progress_queue):
+    """Stream the document summary, publishing partial text to the progress queue."""
     messages = [
+        {
+            "role": "system",
+            "content": SUMMARY_SYSTEM_PROMPT
+        },
         {
             "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": "Please analyze this file and extract all relevant information in detail."
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_data_url
-                    }
-                }
-            ]
+            "content": analysis
         }
     ]
-    
+
+    completion = await client.chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        messages=messages,
+        temperature=0.7,
+        max_tokens=1024,
+        top_p=1,
+        stream=True
+    )
+
+    summary = ""
+    last_publish = 0.0
+    async for chunk in completion:
+        if chunk.choices[0].delta.content is not None:
+            summary += chunk.choices[0].delta.content
+            now = time.monotonic()
+            if now - last_publish > 0.05:
+                progress_queue.put(("summary", summary + "▌"))
+                last_publish = now
+
+    progress_queue.put(("summary", summary))
+    return summary
+
+async def analyze_and_summarize_async(jpegs, page_numbers, duplicates,
+                                      progress_queue):
+    """Analyze all pages, then stream the summary the moment the last page lands."""
+    client = get_async_groq_client()
     try:
-        completion = client.chat.completions.create(
-            model="llama-3.2-90b-vision-preview",
-            messages=messages,
-            temperature=0,
-            max_tokens=3990,
-            top_p=1,
-            stream=False,
-            stop=None
-        )
-        
-        return completion.choices[0].message.content
-        
+        batch_analyses = await analyze_pages_async(client, jpegs, page_numbers,
+                                                   progress_queue)
+        # Batches already carry '--- Page N ---' labels from the model.
+        analysis = "\n\n".join(batch for batch in batch_analyses if batch)
+        if not analysis:
+            return None, None
+        if duplicates:
+            analysis += "\n\n" + "\n".join(
+                f"--- Page {duplicate} ---\nIdentical to page {original}."
+                for duplicate, original in duplicates
+            )
+
+        # The summary request goes out on the same event loop and connection the
+        # page analyses used, so no rerun or client setup sits between them.
+        progress_queue.put(("status", "🤖 Generating summary..."))
+        summary = await generate_summary_async(client, analysis, progress_queue)
+        return analysis, summary
+    finally:
+        # Close the pool before asyncio.run tears the loop down, or the
+        # keep-alive sockets leak on every analyzed document.
+        await client.close()
+
+def analyze_document_worker(file_bytes, file_type, file_hash, progress_queue):
+    """Run the full analyze-and-summarize pipeline off the script thread.
+
+    Publishes ("status" | "progress" | "summary" | "error", value) events to
+    ``progress_queue`` for the script thread to render; must not touch
+    Streamlit APIs itself, since it runs without a script context.
+    """
+    try:
+        if file_type == 'PDF':
+            progress_queue.put(("status", "📄 Processing PDF..."))
+            pdf_jpegs = render_pdf_jpegs(file_bytes)
+
+            # Collapse byte-identical pages (blank pages, repeated separators)
+            # so each unique page hits Groq exactly once. Keep the compact
+            # JPEG bytes here; base64 expansion happens at dispatch time.
+            seen = {}
+            unique_jpegs = []
+            page_numbers = []
+            duplicates = []
+            for i, jpeg in enumerate(pdf_jpegs):
+                digest = hashlib.sha256(jpeg).digest()
+                if digest in seen:
+                    duplicates.append((i + 1, seen[digest]))
+                else:
+                    seen[digest] = i + 1
+                    unique_jpegs.append(jpeg)
+                    page_numbers.append(i + 1)
+
+            analysis, summary = asyncio.run(analyze_and_summarize_async(
+                unique_jpegs, page_numbers, duplicates, progress_queue
+            ))
+
+        else:  # Handle regular images
+            progress_queue.put(("status", "🖼️ Processing image..."))
+            image_data_url = encode_image_to_base64(Image.open(BytesIO(file_bytes)))
+
+            async def analyze_and_summarize_image():
+                client = get_async_groq_client()
+                try:
+                    analysis = await analyze_images_async(client, [image_data_url])
+                    if not analysis:
+                        return None, None
+                    progress_queue.put(("status", "🤖 Generating summary..."))
+                    return analysis, await generate_summary_async(client, analysis,
+                                                                  progress_queue)
+                finally:
+                    await client.close()
+
+            analysis, summary = asyncio.run(analyze_and_summarize_image())
+
+        if not analysis or not summary:
+            return None
+        progress_queue.put(("status", "✅ Analysis complete!"))
+        return {"analysis": analysis, "summary": summary}
+
     except Exception as e:
-        st.error(f"Error during image analysis: {str(e)}")
+        progress_queue.put(("error", f"Error during document analysis: {str(e)}"))
         return None
 
-def analyze_file_content(uploaded_file):
-    """Analyze file content based on file type."""
-    file_type = uploaded_file.type.split('/')[-1].upper()
-    
-    # Create a container for the progress information
-    progress_container = st.sidebar.container()
-    
-    if file_type == 'PDF':
-        with progress_container:
-            st.write("📄 Processing PDF...")
-            pdf_images = convert_pdf_to_images(uploaded_file.getvalue())
-            if not pdf_images:
-                return None
-            
-            all_analyses = []
-            progress_bar = st.progress(0)
-            pages_info = st.empty()
-            
-            for i, image in enumerate(pdf_images):
-                pages_info.write(f"📝 Analyzing page {i+1} of {len(pdf_images)}")
-                image_data_url = encode_image_to_base64(image)
-                page_analysis = analyze_image(image_data_url)
-                if page_analysis:
-                    all_analyses.append(f"Page {i+1}:\n{page_analysis}")
-                progress_bar.progress((i + 1) / len(pdf_images))
-            
-            pages_info.write("✅ Analysis complete!")
-            return "\n\n".join(all_analyses)
-    
-    else:  # Handle regular images
-        with progress_container:
-            st.write("🖼️ Processing image...")
-            image_data_url = encode_image_to_base64(Image.open(uploaded_file))
-            analysis = analyze_image(image_data_url)
-            if analysis:
-                st.write("✅ Analysis complete!")
-            return analysis
-
-def generate_summary(analysis):
-    """Generate detailed summary using the versatile model."""
-    client = get_groq_client()
-    
-    summary_system_prompt = """You are a highly skilled document summarizer. Create a clear, well-structured summary of the provided content analysis following these guidelines:
+def _delta_stream(completion):
+    """Yield content deltas from a streaming chat completion."""
+    for chunk in completion:
+        content = chunk.choices[0].delta.content
+        if content:
+            yield content
+
+SUMMARY_SYSTEM_PROMPT = """You are a highly skilled document summarizer. Create a clear, well-structured summary of the provided content analysis following these guidelines:
 
 1. Start with a brief overview of the document's main topic or purpose
 2. Organize the summary with clear headings and sections using markdown formatting
@@ -150,43 +383,52 @@ Format your response using markdown for better readability:
 
 Aim to make the summary comprehensive yet concise and easily scannable."""
 
-    messages = [
-        {
-            "role": "system",
-            "content": summary_system_prompt
-        },
-        {
-            "role": "user",
-            "content": analysis
-        }
-    ]
-    
-    try:
-        with st.spinner("🤖 Generating summary..."):
-            completion = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1024,
-                top_p=1,
-                stream=True
-            )
-            
-            summary = ""
-            summary_placeholder = st.empty()
-            
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    summary += chunk.choices[0].delta.content
-                    summary_placeholder.markdown(summary + "▌")
-                    time.sleep(0.01)
-            
-            summary_placeholder.markdown(summary)
-            return summary
-            
-    except Exception as e:
-        st.error(f"Error during summary generation: {str(e)}")
-        return None
+def render_analysis_job(job, current_file_hash):
+    """Render progress for a background analysis job, finishing it when done."""
+    # Drain whatever the worker has published since the last rerun.
+    while True:
+        try:
+            kind, value = job["queue"].get_nowait()
+        except queue.Empty:
+            break
+        if kind == "error":
+            job["errors"].append(value)
+        else:
+            job[kind] = value
+
+    st.write(job["status"])
+    st.progress(job["progress"])
+    if job["summary"]:
+        st.markdown(job["summary"])
+    for error in job["errors"]:
+        st.error(error)
+
+    if job["future"].done():
+        result = job["future"].result()
+        st.session_state.analysis_job = None
+        # The rerun below discards everything rendered this run, so park the
+        # errors in session state for the next run to display.
+        st.session_state.analysis_errors = job["errors"]
+        if result:
+            # Only persist clean runs: if any batch errored, the analysis is
+            # missing pages and the disk cache has no TTL, so caching it would
+            # make the failure permanent for this file.
+            if not job["errors"]:
+                store_cached_document(job["file_hash"], result)
+            # The upload may have changed while the job ran; only install the
+            # result into the chat if it belongs to the current file.
+            if job["file_hash"] == current_file_hash:
+                st.session_state.analysis = result["analysis"]
+                st.session_state.messages = [{
+                    "role": "assistant",
+                    "content": result["summary"]
+                }]
+        st.rerun()
+    else:
+        # Poll: hand control back to Streamlit so the UI stays responsive,
+        # then rerun to pick up the worker's next progress events.
+        time.sleep(0.2)
+        st.rerun()
 
 def main():
     st.set_page_config(
@@ -213,21 +455,48 @@ def main():
             st.session_state.current_file = uploaded_file
             st.session_state.messages = []
             st.session_state.analysis = None
+            st.session_state.analysis_errors = []
         
         if uploaded_file:
             file_type = uploaded_file.type.split('/')[-1].upper()
             st.write(f"📎 File type: {file_type}")
-            
-            if st.button("🔍 Analyze Document", use_container_width=True):
-                st.session_state.analysis = analyze_file_content(uploaded_file)
-                if st.session_state.analysis:
-                    summary = generate_summary(st.session_state.analysis)
-                    if summary:
-                        st.session_state.messages = []  # Clear previous messages
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": summary
-                        })
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hashlib.sha256(file_bytes).hexdigest()
+
+            if st.button("🔍 Analyze Document", use_container_width=True,
+                         disabled=st.session_state.analysis_job is not None):
+                st.session_state.analysis_errors = []
+
+                result = load_cached_document(file_hash)
+                if result:
+                    st.session_state.analysis = result["analysis"]
+                    st.session_state.messages = [{
+                        "role": "assistant",
+                        "content": result["summary"]
+                    }]
+                else:
+                    # Run the analysis off the script thread so the UI stays
+                    # responsive; progress comes back through the queue.
+                    progress_queue = queue.Queue()
+                    future = get_analysis_executor().submit(
+                        analyze_document_worker, file_bytes, file_type,
+                        file_hash, progress_queue
+                    )
+                    st.session_state.analysis_job = {
+                        "future": future,
+                        "queue": progress_queue,
+                        "file_hash": file_hash,
+                        "status": "⏳ Starting analysis...",
+                        "progress": 0.0,
+                        "summary": "",
+                        "errors": [],
+                    }
+
+            if st.session_state.analysis_job:
+                render_analysis_job(st.session_state.analysis_job, file_hash)
+            else:
+                for error in st.session_state.analysis_errors:
+                    st.error(error)
         
         st.markdown("---")
         if st.button("🗑️ Clear Chat", use_container_width=True):
@@ -263,16 +532,16 @@ def main():
             # Generate and display assistant response
             with st.chat_message("assistant"):
                 client = get_groq_client()
-                messages = [
-                    {
-                        "role": "system",
-                        "content": f"Previous analysis: {st.session_state.analysis}\n\nProvide a helpful, detailed response to the question."
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt
-                    }
-                ]
+                # Keep the system prefix byte-identical across turns and only
+                # append to the history, so server-side prefix caching can skip
+                # prefill for the shared analysis on every follow-up question.
+                system_msg = {
+                    "role": "system",
+                    "content": f"Previous analysis: {st.session_state.analysis}\n\nProvide a helpful, detailed response to each question."
+                }
+                messages = ([system_msg]
+                            + st.session_state.messages
+                            + [{"role": "user", "content": user_prompt}])
                 
                 # Stream the response
                 completion = client.chat.completions.create(
@@ -284,18 +553,8 @@ def main():
                     stream=True
                 )
                 
-                # Display streaming response
-                response = ""
-                placeholder = st.empty()
-                
-                for chunk in completion:
-                    if chunk.choices[0].delta.content is not None:
-                        response += chunk.choices[0].delta.content
-                        placeholder.markdown(response + "▌")
-                        time.sleep(0.01)
-                
-                # Final response display
-                placeholder.markdown(response)
+                # Display streaming response incrementally
+                response = st.write_stream(_delta_stream(completion))
                 
                 # Add messages to chat history
                 st.session_state.messages.append({"role": "user", "content": user_prompt})